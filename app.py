@@ -1,9 +1,16 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, session, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, send_from_directory, session, abort, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, event, update, cast
+from sqlalchemy.engine import Engine
 from flask_login import LoginManager, login_user, login_required, logout_user, UserMixin, current_user
 from datetime import datetime, date
 from decimal import Decimal
 import os
+import re
+import hashlib
+import hmac
+import sqlite3
+import tempfile
 from dotenv import load_dotenv
 from io import BytesIO
 from reportlab.lib.pagesizes import A4, landscape
@@ -14,8 +21,10 @@ from reportlab.lib.enums import TA_CENTER, TA_LEFT
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 import pandas as pd
-from werkzeug.utils import secure_filename
+from werkzeug.security import generate_password_hash, check_password_hash
 from math import ceil
+from functools import lru_cache
+from PIL import Image as PILImage
 
 # Load .env if present
 load_dotenv('.env') if os.path.exists('.env') else None
@@ -26,20 +35,45 @@ app = Flask(__name__)
 def today_filter(value):
     return value.strftime('%Y-%m-%d') if value else datetime.today().strftime('%Y-%m-%d')
 
+@app.template_filter('logo_url')
+def logo_url_filter(logo_path):
+    if logo_path:
+        return url_for('logo_file', name=os.path.basename(logo_path))
+    return url_for('static', filename='logos/placeholder.png')
+
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev_secret')
 DB_USER = 'u978154199_priyanshu'
 DB_PASS = 'Dhaval308'
 DB_HOST = '185.214.126.7'
 DB_PORT = '3306'
 DB_NAME = 'u978154199_dairy_db_v3'
+PDF_ROWS_PER_TABLE = 50
+LOGO_MAX_AGE = 31536000  # one year
+LOGO_EXT_RE = re.compile(r'\.[a-z0-9]{1,10}')
+HASHED_LOGO_RE = re.compile(r'[0-9a-f]{12}(\.[a-z0-9]{1,10})?')
 UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'static/logos')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['SQLALCHEMY_DATABASE_URI'] = f'mysql+pymysql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['TEMPLATES_AUTO_RELOAD'] = False
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 db = SQLAlchemy(app)
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # Only applies when running against a local SQLite file (e.g. data.db)
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.execute('PRAGMA cache_size=-20000')
+    cursor.close()
+
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
@@ -63,7 +97,7 @@ class Dairy(db.Model):
 class Product(db.Model):
     __tablename__ = 'products'
     id = db.Column(db.Integer, primary_key=True)
-    dairy_id = db.Column(db.Integer, db.ForeignKey('dairies.id'), nullable=False)
+    dairy_id = db.Column(db.Integer, db.ForeignKey('dairies.id'), nullable=False, index=True)
     name = db.Column(db.String(200), nullable=False)
     unit = db.Column(db.String(50), default='litre')
     cost_price = db.Column(db.Numeric(10,2), nullable=False)
@@ -74,6 +108,10 @@ class Product(db.Model):
 
 class StockIn(db.Model):
     __tablename__ = 'stock_in'
+    __table_args__ = (
+        db.Index('ix_stockin_dairy_date', 'dairy_id', 'date'),
+        db.Index('ix_stockin_dairy_product', 'dairy_id', 'product_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     dairy_id = db.Column(db.Integer, db.ForeignKey('dairies.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
@@ -87,6 +125,10 @@ class StockIn(db.Model):
 
 class Sale(db.Model):
     __tablename__ = 'sales'
+    __table_args__ = (
+        db.Index('ix_sales_dairy_date', 'dairy_id', 'date'),
+        db.Index('ix_sales_dairy_product', 'dairy_id', 'product_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     dairy_id = db.Column(db.Integer, db.ForeignKey('dairies.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
@@ -103,12 +145,209 @@ def load_user(user_id):
     return User.query.get(int(user_id))
 
 # -------------------- Helpers --------------------
+# PDF styles, built once and shared read-only by every report
+STYLES = getSampleStyleSheet()
+STYLES.add(ParagraphStyle(name='TitleCenter', parent=STYLES['Title'], alignment=TA_CENTER, fontSize=20, leading=24))
+STYLES.add(ParagraphStyle(name='SubCenter', parent=STYLES['Normal'], alignment=TA_CENTER, fontSize=10))
+STYLES.add(ParagraphStyle(name='CardVal', parent=STYLES['Heading2'], alignment=TA_CENTER, fontSize=13, textColor=colors.HexColor('#D4AF37')))
+STYLES.add(ParagraphStyle(name='CardLabel', parent=STYLES['Normal'], alignment=TA_CENTER, fontSize=9, textColor=colors.white))
+STYLES.add(ParagraphStyle(name='Small', parent=STYLES['Normal'], fontSize=8))
+
+def _parse_date(s):
+    """Parse a YYYY-MM-DD form/query value; empty values give None.
+
+    Raises ValueError for anything else (fromisoformat alone also accepts
+    forms like 20260101 or 2026-W01-1).
+    """
+    if not s:
+        return None
+    if len(s) != 10 or s[4] != '-' or s[7] != '-':
+        raise ValueError(f'Invalid date: {s!r}')
+    return date.fromisoformat(s)
+
 def current_dairy():
+    # Memoized per request; views that change session['dairy_id'] clear it
+    if 'current_dairy' in g:
+        return g.current_dairy
+    result = None
     did = session.get('dairy_id')
     if did:
         d = Dairy.query.get(did)
         if d:
-            return {'id': d.id, 'name': d.name, 'logo': d.logo_path}
+            result = {'id': d.id, 'name': d.name, 'logo': d.logo_path}
+    g.current_dairy = result
+    return result
+
+def _check_password(account, password):
+    """Check a User/Dairy login password, upgrading a legacy plaintext password to a hash."""
+    if account.password.startswith(('pbkdf2:', 'scrypt:')):
+        return check_password_hash(account.password, password)
+    if hmac.compare_digest(account.password.encode(), password.encode()):
+        account.password = generate_password_hash(password)
+        db.session.commit()
+        return True
+    return False
+
+def _adjust_stock(pid, delta, **values):
+    """Add `delta` to a product's current_stock (and set any extra columns) in one UPDATE."""
+    db.session.execute(
+        update(Product)
+        .where(Product.id == pid)
+        .values(current_stock=func.coalesce(Product.current_stock, 0) + delta, **values)
+    )
+
+@lru_cache(maxsize=64)
+def _decode_logo(path, mtime):
+    """Decode the logo at `path` into PNG bytes sized for the PDF header (raises if unreadable).
+
+    `mtime` is only part of the cache key, so a file replaced in place is decoded again.
+    """
+    with PILImage.open(path) as img:
+        out = BytesIO()
+        img.convert('RGBA').resize((240, 90)).save(out, format='PNG')
+        return out.getvalue()
+
+def _logo_png(path, mtime):
+    """Return the cached header PNG for `path`, or None if it can't be read right now."""
+    # Failures raise out of the cached function, so they are retried next time
+    try:
+        return _decode_logo(path, mtime)
+    except Exception:
+        return None
+
+def _as_float(column):
+    # CAST to DOUBLE in SQL so the driver decodes a float directly instead of
+    # building a Decimal per value (CAST AS DOUBLE needs MySQL 8.0.17+)
+    return cast(column, db.Double)
+
+REPORT_COLUMNS = ['date', 'dairy', 'logo', 'product', 'in_qty', 'out_qty', 'cost_price', 'sell_price', 'profit', 'remarks']
+
+def _report_queries(did, f1d, f2d, pid):
+    """Return the stock-in and sales queries filtered by dairy, date range and product."""
+    si_query = StockIn.query
+    s_query = Sale.query
+
+    if did and str(did).isdigit():
+        did_int = int(did)
+        si_query = si_query.filter(StockIn.dairy_id == did_int)
+        s_query = s_query.filter(Sale.dairy_id == did_int)
+    if f1d:
+        si_query = si_query.filter(StockIn.date >= f1d)
+        s_query = s_query.filter(Sale.date >= f1d)
+    if f2d:
+        si_query = si_query.filter(StockIn.date <= f2d)
+        s_query = s_query.filter(Sale.date <= f2d)
+    if pid and str(pid).isdigit():
+        pid_int = int(pid)
+        si_query = si_query.filter(StockIn.product_id == pid_int)
+        s_query = s_query.filter(Sale.product_id == pid_int)
+    return si_query, s_query
+
+def _collect_rows(si_query, s_query, limit=None):
+    """Build the combined stock-in/sales report rows, newest first.
+
+    With `limit`, only the newest `limit` rows of each source are fetched, which
+    is enough to cover the first `limit` rows of the merged report.
+    """
+    si_rows = si_query.join(Dairy, StockIn.dairy_id == Dairy.id).with_entities(
+        StockIn.date, Dairy.name, Dairy.logo_path, StockIn.product_id,
+        _as_float(StockIn.qty), _as_float(StockIn.cost_price), StockIn.remarks
+    )
+    s_rows = s_query.join(Dairy, Sale.dairy_id == Dairy.id).with_entities(
+        Sale.date, Dairy.name, Dairy.logo_path, Sale.product_id,
+        _as_float(Sale.qty), _as_float(Sale.selling_price), Sale.remarks
+    )
+    if limit is not None:
+        si_rows = si_rows.order_by(StockIn.date.desc(), StockIn.id).limit(limit)
+        s_rows = s_rows.order_by(Sale.date.desc(), Sale.id).limit(limit)
+    else:
+        # Full exports: stream the tuples in batches instead of buffering the whole result
+        si_rows = si_rows.yield_per(1000)
+        s_rows = s_rows.yield_per(1000)
+
+    df_in = pd.DataFrame.from_records(iter(si_rows), columns=['date', 'dairy', 'logo', 'product_id', 'in_qty', 'cost_price', 'remarks'])
+    df_in = df_in.astype({'in_qty': float, 'cost_price': float}).assign(out_qty=0.0, sell_price='', profit=0.0)
+
+    df_out = pd.DataFrame.from_records(iter(s_rows), columns=['date', 'dairy', 'logo', 'product_id', 'out_qty', 'sell_price', 'remarks'])
+    df_out = df_out.astype({'out_qty': float, 'sell_price': float}).assign(in_qty=0.0)
+
+    # Product names/costs are looked up once per distinct product rather than
+    # joined onto every row
+    product_ids = {int(p_id) for p_id in pd.concat([df_in['product_id'], df_out['product_id']]).unique()}
+    products = db.session.query(Product.id, Product.name, _as_float(Product.cost_price)).filter(
+        Product.id.in_(product_ids)
+    ).all() if product_ids else []
+    name_by_pid = {p_id: name for p_id, name, _ in products}
+    cost_by_pid = {p_id: cost for p_id, _, cost in products}
+
+    df_in['product'] = df_in['product_id'].map(name_by_pid)
+    df_out['product'] = df_out['product_id'].map(name_by_pid)
+    df_out['cost_price'] = df_out['product_id'].map(cost_by_pid).astype(float)
+    df_out['profit'] = df_out['out_qty'] * (df_out['sell_price'] - df_out['cost_price'])
+
+    frames = [f[REPORT_COLUMNS] for f in (df_in, df_out) if not f.empty]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=REPORT_COLUMNS)
+    df['remarks'] = df['remarks'].fillna('')
+    return df.sort_values('date', ascending=False, kind='stable', ignore_index=True)
+
+def _report_totals(si_query, s_query):
+    """Sum the report totals in the database for the filtered stock-in/sales queries."""
+    in_count, in_qty, cost_val = si_query.with_entities(
+        func.count(StockIn.id), func.sum(StockIn.qty), func.sum(StockIn.qty * StockIn.cost_price)
+    ).one()
+    out_count, out_qty, sell_val, profit = s_query.join(Product, Sale.product_id == Product.id).with_entities(
+        func.count(Sale.id), func.sum(Sale.qty), func.sum(Sale.qty * Sale.selling_price),
+        func.sum(Sale.qty * (Sale.selling_price - Product.cost_price))
+    ).one()
+    return {
+        'row_count': in_count + out_count,
+        'in_qty': float(in_qty or 0),
+        'out_qty': float(out_qty or 0),
+        'cost_val': float(cost_val or 0),
+        'sell_val': float(sell_val or 0),
+        'profit': float(profit or 0),
+    }
+
+def _report_validators(si_query, s_query, did, pid, *content_keys):
+    """Return an (etag, last_modified) pair identifying a report export.
+
+    Entries have no updated_at column, so the etag hashes the exported fields
+    of every matching row plus the products/dairies they print. `content_keys`
+    must cover everything else the export prints (raw filter strings, title, logo).
+    """
+    digest = hashlib.sha1(repr((did, pid) + content_keys).encode())
+    for rows in (
+        si_query.with_entities(StockIn.id, StockIn.date, StockIn.product_id, StockIn.qty,
+                               StockIn.cost_price, StockIn.remarks).order_by(StockIn.id).yield_per(1000),
+        s_query.with_entities(Sale.id, Sale.date, Sale.product_id, Sale.qty,
+                              Sale.selling_price, Sale.remarks).order_by(Sale.id).yield_per(1000),
+    ):
+        digest.update(b'|')
+        for row in rows:
+            digest.update(repr(tuple(row)).encode())
+
+    # Only the products and dairies that can appear in this report
+    products = db.session.query(Product.id, Product.name, Product.cost_price)
+    dairies = db.session.query(Dairy.id, Dairy.name, Dairy.logo_path)
+    if did and str(did).isdigit():
+        products = products.filter(Product.dairy_id == int(did))
+        dairies = dairies.filter(Dairy.id == int(did))
+    if pid and str(pid).isdigit():
+        products = products.filter(Product.id == int(pid))
+    digest.update(repr(products.order_by(Product.id).all()).encode())
+    digest.update(repr(dairies.order_by(Dairy.id).all()).encode())
+
+    last_in = si_query.with_entities(func.max(StockIn.created_at)).scalar()
+    last_out = s_query.with_entities(func.max(Sale.created_at)).scalar()
+    last_modified = max([ts for ts in (last_in, last_out) if ts], default=None)
+    return digest.hexdigest(), last_modified
+
+def _not_modified(etag):
+    """Return a 304 response if the client already holds `etag`, else None."""
+    if request.if_none_match.contains(etag):
+        rv = app.response_class(status=304)
+        rv.set_etag(etag)
+        return rv
     return None
 
 # -------------------- Routes (unchanged core logic) --------------------
@@ -125,16 +364,18 @@ def login():
     if request.method=='POST':
         username = request.form['username']
         password = request.form['password']
-        user = User.query.filter_by(username=username, password=password).first()
-        if user:
+        user = User.query.filter_by(username=username).first()
+        if user and _check_password(user, password):
             login_user(user)
             session.pop('dairy_id', None)
+            g.pop('current_dairy', None)
             return redirect(url_for('admin_dashboard'))
-        dairy = Dairy.query.filter_by(username=username, password=password).first()
-        if dairy:
+        dairy = Dairy.query.filter_by(username=username).first()
+        if dairy and _check_password(dairy, password):
             session['dairy_id'] = dairy.id
             session['dairy_name'] = dairy.name
             session['dairy_logo'] = dairy.logo_path
+            g.pop('current_dairy', None)
             return redirect(url_for('dashboard'))
         flash('Invalid credentials','danger')
     return render_template('login.html', dairy=current_dairy())
@@ -146,13 +387,25 @@ def logout():
     session.pop('dairy_id', None)
     session.pop('dairy_name', None)
     session.pop('dairy_logo', None)
+    g.pop('current_dairy', None)
     return redirect(url_for('login'))
 
 @app.route('/admin')
 @login_required
 def admin_dashboard():
     dairies = Dairy.query.all()
-    return render_template('admin_dashboard.html', dairies=dairies)
+    # Per-dairy KPIs from two grouped queries instead of per-dairy lookups
+    revenue = dict(db.session.query(
+        Sale.dairy_id, func.sum(Sale.qty * Sale.selling_price)
+    ).group_by(Sale.dairy_id).all())
+    stock_value = dict(db.session.query(
+        Product.dairy_id, func.sum(Product.current_stock * Product.cost_price)
+    ).group_by(Product.dairy_id).all())
+    kpis = {
+        d.id: {'revenue': revenue.get(d.id) or 0, 'stock_value': stock_value.get(d.id) or 0}
+        for d in dairies
+    }
+    return render_template('admin_dashboard.html', dairies=dairies, kpis=kpis)
 
 @app.route('/admin/dairies/add', methods=['GET','POST'])
 @login_required
@@ -164,16 +417,32 @@ def add_dairy():
         logo = request.files.get('logo')
         logo_path = None
         if logo and logo.filename:
-            filename = secure_filename(logo.filename)
+            # Content-hashed name so /logos/<name> can be cached as immutable
+            # Extension comes from the raw name (only a short alphanumeric one is kept)
+            ext = os.path.splitext(logo.filename)[1].lower()
+            ext = ext if LOGO_EXT_RE.fullmatch(ext) else ''
+            filename = hashlib.sha1(logo.read()).hexdigest()[:12] + ext
+            logo.stream.seek(0)
             dest = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             logo.save(dest)
             logo_path = dest
-        d = Dairy(name=name, username=username, password=password, logo_path=logo_path)
+            _decode_logo.cache_clear()
+        d = Dairy(name=name, username=username, password=generate_password_hash(password), logo_path=logo_path)
         db.session.add(d); db.session.commit()
         flash('Dairy added','success')
         return redirect(url_for('admin_dashboard'))
     return render_template('add_dairy.html')
 
+@app.route('/logos/<path:name>')
+def logo_file(name):
+    # Content-hashed names never change once served; older uploads kept their
+    # original names and get the default caching
+    if HASHED_LOGO_RE.fullmatch(name):
+        rv = send_from_directory(app.config['UPLOAD_FOLDER'], name, max_age=LOGO_MAX_AGE)
+        rv.cache_control.immutable = True
+        return rv
+    return send_from_directory(app.config['UPLOAD_FOLDER'], name)
+
 @app.route('/admin/dairies/<int:did>/view')
 @login_required
 def admin_view_dairy(did):
@@ -181,6 +450,7 @@ def admin_view_dairy(did):
     session['dairy_id'] = d.id
     session['dairy_name'] = d.name
     session['dairy_logo'] = d.logo_path
+    g.pop('current_dairy', None)
     flash(f'Now viewing as {d.name}','info')
     return redirect(url_for('dashboard'))
 
@@ -199,30 +469,36 @@ def dashboard():
     f2 = request.args.get('to')
 
     try:
-        f1d = datetime.strptime(f1, '%Y-%m-%d').date() if f1 else datetime.today().date()
-        f2d = datetime.strptime(f2, '%Y-%m-%d').date() if f2 else datetime.today().date()
-    except:
+        f1d = _parse_date(f1) or datetime.today().date()
+        f2d = _parse_date(f2) or datetime.today().date()
+    except ValueError:
         f1d = f2d = datetime.today().date()
 
-    stock_ins = StockIn.query.filter(
+    # Aggregate per product in the database instead of looping over every row
+    in_by_p = dict(db.session.query(StockIn.product_id, func.sum(StockIn.qty)).filter(
         StockIn.dairy_id == dairy_id,
         StockIn.date.between(f1d, f2d)
-    ).all()
-
-    sales = Sale.query.filter(
-        Sale.dairy_id == dairy_id,
-        Sale.date.between(f1d, f2d)
-    ).all()
+    ).group_by(StockIn.product_id).all())
+
+    sales_by_p = {
+        product_id: (qty, revenue)
+        for product_id, qty, revenue in db.session.query(
+            Sale.product_id, func.sum(Sale.qty), func.sum(Sale.qty * Sale.selling_price)
+        ).filter(
+            Sale.dairy_id == dairy_id,
+            Sale.date.between(f1d, f2d)
+        ).group_by(Sale.product_id).all()
+    }
 
     total_stock_value = sum([p.current_stock * p.cost_price for p in products])
-    total_revenue = sum([s.qty * s.selling_price for s in sales])
-    total_cogs = sum([s.qty * s.product.cost_price for s in sales])
+    total_revenue = sum([revenue for _, revenue in sales_by_p.values()])
+    total_cogs = sum([sales_by_p[p.id][0] * p.cost_price for p in products if p.id in sales_by_p])
     profit = total_revenue - total_cogs
 
     product_stock_summary = []
     for p in products:
-        stock_in_qty = sum(si.qty for si in stock_ins if si.product_id == p.id)
-        sale_qty = sum(s.qty for s in sales if s.product_id == p.id)
+        stock_in_qty = in_by_p.get(p.id, 0)
+        sale_qty = sales_by_p[p.id][0] if p.id in sales_by_p else 0
         closing_stock = p.current_stock
         product_stock_summary.append({
             'name': p.name,
@@ -314,11 +590,13 @@ def stock_in_page():
         pid = int(request.form['product_id']); qty = Decimal(request.form['qty'] or 0)
         cost_price = Decimal(request.form['cost_price'] or 0); date_str = request.form.get('date') or date.today().isoformat()
         remarks = request.form.get('remarks') or ''
-        st = StockIn(dairy_id=d['id'], product_id=pid, qty=qty, cost_price=cost_price, date=datetime.strptime(date_str, '%Y-%m-%d').date(), remarks=remarks)
+        try:
+            entry_date = _parse_date(date_str)
+        except ValueError:
+            flash('Invalid date, use YYYY-MM-DD', 'danger'); return redirect(url_for('stock_in_page'))
+        st = StockIn(dairy_id=d['id'], product_id=pid, qty=qty, cost_price=cost_price, date=entry_date, remarks=remarks)
         db.session.add(st)
-        prod = Product.query.get(pid)
-        prod.current_stock = Decimal(prod.current_stock or 0) + qty
-        prod.cost_price = cost_price
+        _adjust_stock(pid, qty, cost_price=cost_price)
         db.session.commit(); flash('Stock added','success'); return redirect(url_for('stock_in_page'))
     trans = StockIn.query.filter_by(dairy_id=d['id']).order_by(StockIn.date.desc()).limit(200).all()
     today = datetime.today().strftime('%Y-%m-%d') 
@@ -331,13 +609,18 @@ def edit_stock_in(sid):
     st = StockIn.query.get_or_404(sid)
     if st.dairy_id != d['id']: abort(403)
     if request.method=='POST':
+        try:
+            entry_date = _parse_date(request.form.get('date'))
+        except ValueError:
+            entry_date = None
+        if not entry_date:
+            flash('Invalid date, use YYYY-MM-DD', 'danger'); return redirect(url_for('edit_stock_in', sid=sid))
         old_qty = st.qty
         st.qty = Decimal(request.form['qty'] or 0)
         st.cost_price = Decimal(request.form['cost_price'] or 0)
-        st.date = datetime.strptime(request.form.get('date'), '%Y-%m-%d').date()
+        st.date = entry_date
         st.remarks = request.form.get('remarks') or ''
-        prod = Product.query.get(st.product_id)
-        prod.current_stock = Decimal(prod.current_stock or 0) - old_qty + st.qty
+        _adjust_stock(st.product_id, st.qty - old_qty)
         db.session.commit(); flash('Stock entry updated','success'); 
         return redirect(url_for('stock_in_page'))
     today = datetime.today().strftime('%Y-%m-%d')    
@@ -353,11 +636,13 @@ def sales_page():
         pid = int(request.form['product_id']); qty = Decimal(request.form['qty'] or 0)
         selling_price = Decimal(request.form['selling_price'] or 0); date_str = request.form.get('date') or date.today().isoformat()
         remarks = request.form.get('remarks') or ''
-        sale = Sale(dairy_id=d['id'], product_id=pid, qty=qty, selling_price=selling_price, date=datetime.strptime(date_str, '%Y-%m-%d').date(), remarks=remarks)
+        try:
+            sale_date = _parse_date(date_str)
+        except ValueError:
+            flash('Invalid date, use YYYY-MM-DD', 'danger'); return redirect(url_for('sales_page'))
+        sale = Sale(dairy_id=d['id'], product_id=pid, qty=qty, selling_price=selling_price, date=sale_date, remarks=remarks)
         db.session.add(sale)
-        prod = Product.query.get(pid)
-        prod.current_stock = Decimal(prod.current_stock or 0) - qty
-        prod.sell_price = selling_price
+        _adjust_stock(pid, -qty, sell_price=selling_price)
         db.session.commit(); flash('Sale recorded','success'); return redirect(url_for('sales_page'))
     sales = Sale.query.filter_by(dairy_id=d['id']).order_by(Sale.date.desc()).limit(200).all()
     today = datetime.today().strftime('%Y-%m-%d') 
@@ -370,13 +655,18 @@ def edit_sale(sid):
     sale = Sale.query.get_or_404(sid)
     if sale.dairy_id != d['id']: abort(403)
     if request.method=='POST':
+        try:
+            sale_date = _parse_date(request.form.get('date'))
+        except ValueError:
+            sale_date = None
+        if not sale_date:
+            flash('Invalid date, use YYYY-MM-DD', 'danger'); return redirect(url_for('edit_sale', sid=sid))
         old_qty = sale.qty
         sale.qty = Decimal(request.form['qty'] or 0)
         sale.selling_price = Decimal(request.form['selling_price'] or 0)
-        sale.date = datetime.strptime(request.form.get('date'), '%Y-%m-%d').date()
+        sale.date = sale_date
         sale.remarks = request.form.get('remarks') or ''
-        prod = Product.query.get(sale.product_id)
-        prod.current_stock = Decimal(prod.current_stock or 0) + old_qty - sale.qty
+        _adjust_stock(sale.product_id, old_qty - sale.qty)
         db.session.commit(); flash('Sale updated','success'); return redirect(url_for('sales_page'))
     today = datetime.today().strftime('%Y-%m-%d')    
     return render_template('sale_form.html', sale=sale, dairy=d,today=today)
@@ -387,9 +677,7 @@ def delete_sale(sid):
     if not d: return redirect(url_for('login'))
     sale = Sale.query.get_or_404(sid)
     if sale.dairy_id != d['id']: abort(403)
-    prod = Product.query.get(sale.product_id)
-    if prod:
-        prod.current_stock = Decimal(prod.current_stock or 0) + sale.qty
+    _adjust_stock(sale.product_id, sale.qty)
     db.session.delete(sale)
     db.session.commit()
     flash('Sale entry deleted', 'success')
@@ -400,8 +688,6 @@ def delete_sale(sid):
 def reports():
     dairies = Dairy.query.all() if current_user.is_authenticated else None
     d = current_dairy()
-    rows = []
-    totals = {'in_qty': 0, 'out_qty': 0, 'cost_val': 0, 'sell_val': 0, 'profit': 0}
     today_str = datetime.today().strftime('%Y-%m-%d')
     f1 = request.form.get('from') or request.args.get('from') or today_str
     f2 = request.form.get('to') or request.args.get('to') or today_str
@@ -409,86 +695,26 @@ def reports():
     did = request.form.get('dairy') or request.args.get('dairy') or (d['id'] if d else None)
 
     try:
-        f1d = datetime.strptime(f1, '%Y-%m-%d').date() if f1 else None
-        f2d = datetime.strptime(f2, '%Y-%m-%d').date() if f2 else None
-    except:
+        f1d = _parse_date(f1)
+        f2d = _parse_date(f2)
+    except ValueError:
         f1d = f2d = None
 
-    si_query = StockIn.query
-    s_query = Sale.query
+    si_query, s_query = _report_queries(did, f1d, f2d, pid)
 
-    if did and str(did).isdigit():
-        did_int = int(did)
-        si_query = si_query.filter(StockIn.dairy_id == did_int)
-        s_query = s_query.filter(Sale.dairy_id == did_int)
-    if f1d:
-        si_query = si_query.filter(StockIn.date >= f1d)
-        s_query = s_query.filter(Sale.date >= f1d)
-    if f2d:
-        si_query = si_query.filter(StockIn.date <= f2d)
-        s_query = s_query.filter(Sale.date <= f2d)
-    if pid and str(pid).isdigit():
-        pid_int = int(pid)
-        si_query = si_query.filter(StockIn.product_id == pid_int)
-        s_query = s_query.filter(Sale.product_id == pid_int)
-
-    sis = si_query.all()
-    ss = s_query.all()
-
-    for entry in sis:
-        rows.append({
-            'dairy': entry.dairy.name,
-            'logo': entry.dairy.logo_path,
-            'date': entry.date,
-            'product': entry.product.name,
-            'in_qty': float(entry.qty),
-            'out_qty': 0.0,
-            'cost_price': float(entry.cost_price),
-            'sell_price': '',
-            'profit': 0.0,
-            'remarks': entry.remarks or ''
-        })
-        totals['in_qty'] += float(entry.qty)
-        totals['cost_val'] += float(entry.qty) * float(entry.cost_price)
-
-    for s in ss:
-        profit = float(s.qty * (s.selling_price - s.product.cost_price))
-        rows.append({
-            'dairy': s.dairy.name,
-            'logo': s.dairy.logo_path,
-            'date': s.date,
-            'product': s.product.name,
-            'in_qty': 0.0,
-            'out_qty': float(s.qty),
-            'cost_price': float(s.product.cost_price),
-            'sell_price': float(s.selling_price),
-            'profit': profit,
-            'remarks': s.remarks or ''
-        })
-        totals['out_qty'] += float(s.qty)
-        totals['sell_val'] += float(s.qty) * float(s.selling_price)
-        totals['profit'] += profit
+    totals = _report_totals(si_query, s_query)
 
-    rows = sorted(rows, key=lambda x: x['date'], reverse=True)
-
-    # Pagination
-    page = int(request.args.get('page', 1))
+    # Pagination: only fetch the rows needed up to the requested page
+    page = max(int(request.args.get('page', 1)), 1)
     per_page = 10
     start = (page - 1) * per_page
     end = start + per_page
-    total_pages = ceil(len(rows) / per_page) if rows else 1
-    paginated_rows = rows[start:end]
-
-    # Save Excel
-    if rows:
-        df = pd.DataFrame(rows)
-        output_dir = os.path.join('static', 'reports')
-        os.makedirs(output_dir, exist_ok=True)
-        excel_path = os.path.join(output_dir, 'report_v3.xlsx')
-        df.to_excel(excel_path, index=False)
-        out = True
-    else:
-        out = False
+    total_pages = ceil(totals['row_count'] / per_page) if totals['row_count'] else 1
+    df = _collect_rows(si_query, s_query, limit=end)
+    paginated_rows = df.iloc[start:end].to_dict('records')
+
+    # Excel is generated on demand by /reports/xlsx
+    out = totals['row_count'] > 0
 
     products = Product.query.filter_by(dairy_id=int(did)).all() if did and str(did).isdigit() else []
 
@@ -506,6 +732,35 @@ def reports():
                            page=page,
                            total_pages=total_pages)
 
+# Excel export of the same report, generated only when requested
+@app.route('/reports/xlsx', endpoint='reports_xlsx')
+def reports_xlsx():
+    f1 = request.args.get('from')
+    f2 = request.args.get('to')
+    pid = request.args.get('product')
+    did = request.args.get('dairy')
+
+    try:
+        f1d = _parse_date(f1)
+        f2d = _parse_date(f2)
+    except ValueError:
+        f1d = f2d = None
+
+    si_query, s_query = _report_queries(did, f1d, f2d, pid)
+    etag, last_modified = _report_validators(si_query, s_query, did, pid, 'xlsx', f1, f2)
+    cached = _not_modified(etag)
+    if cached:
+        return cached
+    df = _collect_rows(si_query, s_query)
+
+    buffer = BytesIO()
+    df.to_excel(buffer, index=False)
+    buffer.seek(0)
+    filter_key = hashlib.sha1(f'{did}|{f1d}|{f2d}|{pid}'.encode()).hexdigest()[:10]
+    return send_file(buffer, as_attachment=True, download_name=f'report_{filter_key}.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                     conditional=True, etag=etag, last_modified=last_modified)
+
 # -------------------- New/Updated PDF generator route (Modern Royal Blue, logo top-right, footer) --------------------
 @app.route('/reports/pdf', endpoint='reports_pdf')
 def reports_pdf():
@@ -515,86 +770,14 @@ def reports_pdf():
     pid = request.args.get('product')
     did = request.args.get('dairy')
 
-    si_query = StockIn.query
-    s_query = Sale.query
-
     try:
-        if did and str(did).isdigit():
-            did_int = int(did)
-            si_query = si_query.filter(StockIn.dairy_id == did_int)
-            s_query = s_query.filter(Sale.dairy_id == did_int)
-        if f1:
-            f1d = datetime.strptime(f1, '%Y-%m-%d').date()
-            si_query = si_query.filter(StockIn.date >= f1d)
-            s_query = s_query.filter(Sale.date >= f1d)
-        if f2:
-            f2d = datetime.strptime(f2, '%Y-%m-%d').date()
-            si_query = si_query.filter(StockIn.date <= f2d)
-            s_query = s_query.filter(Sale.date <= f2d)
-    except Exception as e:
+        f1d = _parse_date(f1)
+        f2d = _parse_date(f2)
+    except ValueError:
         # if parsing fails, ignore date filters
         f1d = f2d = None
 
-    if pid and str(pid).isdigit():
-        pid_int = int(pid)
-        si_query = si_query.filter(StockIn.product_id == pid_int)
-        s_query = s_query.filter(Sale.product_id == pid_int)
-
-    sis = si_query.order_by(StockIn.date.desc()).all()
-    ss = s_query.order_by(Sale.date.desc()).all()
-
-    # Build rows and totals
-    rows = []
-    totals = {'in_qty': 0.0, 'out_qty': 0.0, 'cost_val': 0.0, 'sell_val': 0.0, 'profit': 0.0}
-
-    for entry in sis:
-        rows.append({
-            'date': entry.date,
-            'dairy': entry.dairy.name,
-            'product': entry.product.name,
-            'in_qty': float(entry.qty),
-            'out_qty': 0.0,
-            'cost_price': float(entry.cost_price),
-            'sell_price': '',
-            'profit': 0.0,
-            'remarks': entry.remarks or ''
-        })
-        totals['in_qty'] += float(entry.qty)
-        totals['cost_val'] += float(entry.qty) * float(entry.cost_price)
-
-    for s in ss:
-        profit = float(s.qty * (s.selling_price - s.product.cost_price))
-        rows.append({
-            'date': s.date,
-            'dairy': s.dairy.name,
-            'product': s.product.name,
-            'in_qty': 0.0,
-            'out_qty': float(s.qty),
-            'cost_price': float(s.product.cost_price),
-            'sell_price': float(s.selling_price),
-            'profit': profit,
-            'remarks': s.remarks or ''
-        })
-        totals['out_qty'] += float(s.qty)
-        totals['sell_val'] += float(s.qty) * float(s.selling_price)
-        totals['profit'] += profit
-
-    rows = sorted(rows, key=lambda x: x['date'] or datetime.min.date(), reverse=True)
-
-    # Prepare PDF
-    buffer = BytesIO()
-    page_size = landscape(A4)
-    doc = SimpleDocTemplate(buffer, pagesize=page_size,
-                            rightMargin=20, leftMargin=20, topMargin=60, bottomMargin=40)
-
-    # Styles
-    styles = getSampleStyleSheet()
-    styles.add(ParagraphStyle(name='TitleCenter', parent=styles['Title'], alignment=TA_CENTER, fontSize=20, leading=24))
-    styles.add(ParagraphStyle(name='SubCenter', parent=styles['Normal'], alignment=TA_CENTER, fontSize=10))
-    styles.add(ParagraphStyle(name='CardVal', parent=styles['Heading2'], alignment=TA_CENTER, fontSize=13, textColor=colors.HexColor('#D4AF37')))
-    styles.add(ParagraphStyle(name='CardLabel', parent=styles['Normal'], alignment=TA_CENTER, fontSize=9, textColor=colors.white))
-    styles.add(ParagraphStyle(name='Small', parent=styles['Normal'], fontSize=8))
-    elems = []
+    si_query, s_query = _report_queries(did, f1d, f2d, pid)
 
     # Logo resolution: prefer dairy-specific logo if available, else placeholder
     dairy_obj = Dairy.query.get(int(did)) if did and str(did).isdigit() else None
@@ -612,24 +795,44 @@ def reports_pdf():
             if os.path.exists(possible):
                 logo_path = possible
 
+    # Title falls back to the session's dairy when no dairy filter is given
+    title = dairy_obj.name if dairy_obj else (current_dairy()['name'] if current_dairy() else "Dairy Report")
+    logo_mtime = os.path.getmtime(logo_path) if os.path.exists(logo_path) else None
+
+    # Build rows and totals (skipped entirely if the client's copy is current)
+    etag, last_modified = _report_validators(si_query, s_query, did, pid, 'pdf', f1, f2,
+                                             title, logo_path, logo_mtime)
+    cached = _not_modified(etag)
+    if cached:
+        return cached
+    totals = _report_totals(si_query, s_query)
+    df = _collect_rows(si_query, s_query)
+    rows = df.to_dict('records')
+
+    # Prepare PDF (spills to disk for very large reports)
+    buffer = tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024)
+    page_size = landscape(A4)
+    doc = SimpleDocTemplate(buffer, pagesize=page_size,
+                            rightMargin=20, leftMargin=20, topMargin=60, bottomMargin=40)
+
+    elems = []
+
     # Header: we'll place logo at top-right by using a small table with two cells: left blank/title, right logo
     header_data = []
 
     # Prepare title column (left) and logo column (right)
-    title_para = Paragraph(dairy_obj.name if dairy_obj else (current_dairy()['name'] if current_dairy() else "Dairy Report"), styles['TitleCenter'])
+    title_para = Paragraph(title, STYLES['TitleCenter'])
     # create a small RLImage if exists
     logo_img = None
-    if os.path.exists(logo_path):
-        try:
-            logo_img = RLImage(logo_path)
-            logo_img.drawHeight = 45
-            logo_img.drawWidth = 120
-        except Exception:
-            logo_img = None
+    logo_png = _logo_png(logo_path, logo_mtime) if logo_mtime is not None else None
+    if logo_png:
+        logo_img = RLImage(BytesIO(logo_png))
+        logo_img.drawHeight = 45
+        logo_img.drawWidth = 120
 
     # Build a header table: left column = title paragraphs stacked, right column = logo (if present)
-    left_col = [title_para, Spacer(1,6), Paragraph("Stock & Sales Report", styles['SubCenter']),
-                Spacer(1,6), Paragraph(f"Period: {f1 or '-'} to {f2 or '-'}", styles['SubCenter'])]
+    left_col = [title_para, Spacer(1,6), Paragraph("Stock & Sales Report", STYLES['SubCenter']),
+                Spacer(1,6), Paragraph(f"Period: {f1 or '-'} to {f2 or '-'}", STYLES['SubCenter'])]
     # left content as a single paragraph (will be centered later)
     left_combined = []
     for item in left_col:
@@ -655,9 +858,9 @@ def reports_pdf():
     card_bg = colors.HexColor('#0B3D91')  # Royal Blue
     card_table = Table([
         [
-            Paragraph(f"<b> <font color='#D4AF37'>Total Stock In</font></b><br/><font size=12 color='#D4AF37'>{totals['in_qty']:.2f}</font>", styles['Normal']),
-            Paragraph(f"<b> <font color='#D4AF37'>Total Stock Out</font></b><br/><font size=12 color='#D4AF37'>{totals['out_qty']:.2f}</font>", styles['Normal']),
-            Paragraph(f"<b> <font color='#D4AF37'>Total Profit</font></b><br/><font size=12 color='#D4AF37'>{totals['profit']:.2f}</font>", styles['Normal'])
+            Paragraph(f"<b> <font color='#D4AF37'>Total Stock In</font></b><br/><font size=12 color='#D4AF37'>{totals['in_qty']:.2f}</font>", STYLES['Normal']),
+            Paragraph(f"<b> <font color='#D4AF37'>Total Stock Out</font></b><br/><font size=12 color='#D4AF37'>{totals['out_qty']:.2f}</font>", STYLES['Normal']),
+            Paragraph(f"<b> <font color='#D4AF37'>Total Profit</font></b><br/><font size=12 color='#D4AF37'>{totals['profit']:.2f}</font>", STYLES['Normal'])
         ]
     ], colWidths=[doc.width/3.0]*3)
     card_table.setStyle(TableStyle([
@@ -674,11 +877,10 @@ def reports_pdf():
     elems.append(Spacer(1, 14))
 
     # Build detailed table data
-    table_data = []
     header = ['Date', 'Dairy', 'Product', 'Stock In', 'Stock Out', 'Cost P', 'S.P', 'P/L', 'Remarks']
-    table_data.append(header)
+    body = []
     for r in rows:
-        table_data.append([
+        body.append([
             r['date'].isoformat() if hasattr(r['date'], 'isoformat') else str(r['date']),
             r['dairy'],
             r['product'],
@@ -691,7 +893,7 @@ def reports_pdf():
         ])
 
     # Totals row
-    table_data.append([
+    totals_row = [
         'Totals', '', '',
         f"{totals['in_qty']:.2f}",
         f"{totals['out_qty']:.2f}",
@@ -699,37 +901,45 @@ def reports_pdf():
         f"{totals['sell_val']:.2f}",
         f"{totals['profit']:.2f}",
         ''
-    ])
+    ]
 
     # Column widths (tweak as necessary)
     col_widths = [70, 90, 140, 60, 60, 60, 60, 80, doc.width - (70+90+140+60+60+60+60+80)]
-    report_table = Table(table_data, colWidths=col_widths, repeatRows=1)
-
-    # Table styling: modern header (royal blue + gold), zebra rows
-    report_table_style = TableStyle([
-        ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#0B3D91')),
-        ('TEXTCOLOR', (0,0), (-1,0), colors.HexColor('#D4AF37')),
-        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0,0), (-1,0), 10),
-        ('ALIGN', (3,1), (7,-2), 'RIGHT'),
-        ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-        ('INNERGRID', (0,0), (-1,-1), 0.25, colors.grey),
-        ('BOX', (0,0), (-1,-1), 0.5, colors.black),
-        ('LEFTPADDING', (0,0), (-1,-1), 6),
-        ('RIGHTPADDING', (0,0), (-1,-1), 6),
-        ('TOPPADDING', (0,0), (-1,-1), 4),
-        ('BOTTOMPADDING', (0,0), (-1,-1), 4),
-        ('FONTNAME', (0, len(table_data)-1), (-1, len(table_data)-1), 'Helvetica-Bold'),
-        ('BACKGROUND', (0, len(table_data)-1), (-1, len(table_data)-1), colors.HexColor('#F2F4F8')),
-    ])
-
-    # zebra body rows
-    for i in range(1, len(table_data)-1):
-        if i % 2 == 1:
-            report_table_style.add('BACKGROUND', (0,i), (-1,i), colors.whitesmoke)
-
-    report_table.setStyle(report_table_style)
-    elems.append(report_table)
+
+    # Lay the rows out as several small tables: ReportLab's table layout gets
+    # much slower as a single table grows, so keep each one bounded
+    chunks = [body[i:i + PDF_ROWS_PER_TABLE] for i in range(0, len(body), PDF_ROWS_PER_TABLE)] or [[]]
+    for n, chunk in enumerate(chunks):
+        is_last = n == len(chunks) - 1
+        table_data = [header] + chunk + ([totals_row] if is_last else [])
+        report_table = Table(table_data, colWidths=col_widths, repeatRows=1)
+
+        # Table styling: modern header (royal blue + gold), zebra rows
+        report_table_style = TableStyle([
+            ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#0B3D91')),
+            ('TEXTCOLOR', (0,0), (-1,0), colors.HexColor('#D4AF37')),
+            ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0,0), (-1,0), 10),
+            ('ALIGN', (3,1), (7,-2 if is_last else -1), 'RIGHT'),
+            ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+            ('INNERGRID', (0,0), (-1,-1), 0.25, colors.grey),
+            ('BOX', (0,0), (-1,-1), 0.5, colors.black),
+            ('LEFTPADDING', (0,0), (-1,-1), 6),
+            ('RIGHTPADDING', (0,0), (-1,-1), 6),
+            ('TOPPADDING', (0,0), (-1,-1), 4),
+            ('BOTTOMPADDING', (0,0), (-1,-1), 4),
+        ])
+        if is_last:
+            report_table_style.add('FONTNAME', (0,-1), (-1,-1), 'Helvetica-Bold')
+            report_table_style.add('BACKGROUND', (0,-1), (-1,-1), colors.HexColor('#F2F4F8'))
+
+        # zebra body rows (numbered across the whole report)
+        for i in range(1, len(chunk) + 1):
+            if (n * PDF_ROWS_PER_TABLE + i) % 2 == 1:
+                report_table_style.add('BACKGROUND', (0,i), (-1,i), colors.whitesmoke)
+
+        report_table.setStyle(report_table_style)
+        elems.append(report_table)
 
     # Footer function: page number + generated timestamp
     def _footer(canvas, doc):
@@ -746,18 +956,31 @@ def reports_pdf():
     # Build PDF and return
     doc.build(elems, onFirstPage=_footer, onLaterPages=_footer)
     buffer.seek(0)
-    return send_file(buffer, as_attachment=True, download_name='report_v3.pdf', mimetype='application/pdf')
+    return send_file(buffer, as_attachment=True, download_name='report_v3.pdf', mimetype='application/pdf',
+                     conditional=True, etag=etag, last_modified=last_modified)
 
 # Utility: initdb
 @app.cli.command('initdb')
 def initdb():
     db.create_all()
     if not User.query.filter_by(username='admin').first():
-        u = User(username='admin', password='admin'); db.session.add(u)
+        u = User(username='admin', password=generate_password_hash('admin')); db.session.add(u)
     if not Dairy.query.first():
-        d = Dairy(name='Sample Dairy', username='dairy', password='dairy', logo_path=None); db.session.add(d); db.session.commit()
+        d = Dairy(name='Sample Dairy', username='dairy', password=generate_password_hash('dairy'), logo_path=None); db.session.add(d); db.session.commit()
     db.session.commit()
     print('Initialized DB and created default admin (admin/admin) and sample dairy (dairy/dairy)')
 
+# Utility: add-indexes (create_all never adds indexes to tables that already exist)
+@app.cli.command('add-indexes')
+def add_indexes():
+    for table in (Product.__table__, StockIn.__table__, Sale.__table__):
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+            print(f'Ensured index {index.name} on {table.name}')
+
+# Compile all templates once at startup so the first requests don't pay for parsing
+for template_name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template_name)
+
 if __name__=='__main__':
     app.run()